@@ -0,0 +1,103 @@
+import asyncio
+from collections import OrderedDict
+from itertools import count
+
+from .generated import labgrid_coordinator_pb2
+
+
+def serialize_update(update):
+    """Serialize an UpdateResponse as a ClientOutMessage containing only this
+    update.
+
+    As updates is a repeated field, the concatenation of such messages is a
+    valid ClientOutMessage containing all of them. This allows serializing
+    each update once and sharing the bytes between all client streams.
+    """
+    msg = labgrid_coordinator_pb2.ClientOutMessage()
+    msg.updates.append(update)
+    return msg.SerializeToString()
+
+
+def serialize_sync(sync_id):
+    msg = labgrid_coordinator_pb2.ClientOutMessage()
+    msg.sync.id = sync_id
+    return msg.SerializeToString()
+
+
+def update_key(update):
+    """Return the key identifying the place or resource an UpdateResponse
+    refers to. A newer update with the same key supersedes an older one."""
+    kind = update.WhichOneof("kind")
+    if kind == "resource":
+        path = update.resource.path
+    elif kind == "del_resource":
+        path = update.del_resource
+    elif kind == "place":
+        return ("place", update.place.name)
+    elif kind == "del_place":
+        return ("place", update.del_place)
+    else:
+        raise ValueError(f"unknown update kind {kind}")
+    return ("resource", path.exporter_name, path.group_name, path.resource_name)
+
+
+class ClientOutQueue:
+    """Output queue for a single client stream, containing pre-serialized
+    ClientOutMessage parts.
+
+    Updates are coalesced by their key, so a client which falls behind only
+    receives the latest state of each place or resource. Sync responses are
+    never coalesced and end the message they are sent in, as a
+    ClientOutMessage can only contain one of them.
+    """
+
+    max_updates = 100
+
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.event = asyncio.Event()
+        self.sync_ids = count()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put_update(self, key, data):
+        # a superseded update keeps its position, so updates for other keys
+        # are not delayed by a frequently changing resource
+        self.pending[key] = data
+        self.event.set()
+
+    def put_sync(self, sync_id):
+        self.pending[("sync", next(self.sync_ids))] = serialize_sync(sync_id)
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    def get_nowait(self):
+        "Return the next serialized ClientOutMessage or None if nothing is pending."
+        parts = []
+        while self.pending and len(parts) < self.max_updates:
+            key, data = self.pending.popitem(last=False)
+            parts.append(data)
+            if key[0] == "sync":
+                break
+        if not self.pending:
+            self.event.clear()
+        return b"".join(parts) if parts else None
+
+    async def messages(self):
+        while True:
+            msg = self.get_nowait()
+            if msg is not None:
+                yield msg
+                continue
+            if self.closed:
+                return
+            try:
+                await self.event.wait()
+            except asyncio.CancelledError:
+                # gRPC doesn't like to receive exceptions from the response iterator
+                return
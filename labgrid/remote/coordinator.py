@@ -20,6 +20,7 @@ from .common import (
     TAG_KEY,
     TAG_VAL,
 )
+from .matchindex import ResourceMatchIndex
 from .scheduler import TagSet, schedule
 from .generated import labgrid_coordinator_pb2
 from .generated import labgrid_coordinator_pb2_grpc
@@ -64,6 +65,7 @@ class ExporterSession(RemoteSession):
                 new = old
             else:
                 group[resourcename] = new
+                self.coordinator.match_index.add_resource(new)
         else:
             new = None
             if old.acquired:
@@ -72,6 +74,7 @@ class ExporterSession(RemoteSession):
                 del group[resourcename]
             except KeyError:
                 pass
+            self.coordinator.match_index.remove_resource(old)
 
         msg = labgrid_coordinator_pb2.ClientOutMessage()
         update = msg.updates.add()
@@ -164,6 +167,26 @@ def locked(func):
     return wrapper
 
 
+def place_locked(func):
+    """Hold the lock of the place named in request.placename."""
+
+    @wraps(func)
+    async def wrapper(self, request, context):
+        async with self._get_place_lock(request.placename):
+            return await func(self, request, context)
+
+    return wrapper
+
+
+def reservation_locked(func):
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        async with self.reservation_lock:
+            return await func(self, *args, **kwargs)
+
+    return wrapper
+
+
 class ExporterCommand:
     def __init__(self, request) -> None:
         self.request = request
@@ -189,9 +212,19 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         self.poll_task = None
         self.save_scheduled = False
 
+        # Lock order: self.lock (the place table) -> one place lock ->
+        # self.reservation_lock. Never wait for a lock while holding a later
+        # one. While holding a place lock, other place locks may only be taken
+        # if they are free (see _reacquire_orphaned_resources()).
         self.lock = asyncio.Lock()
+        self.place_locks: dict[str, asyncio.Lock] = {}
+        self.reservation_lock = asyncio.Lock()
+        # resources with pending acquire requests, to avoid conflicts between
+        # places acquired concurrently
+        self.acquiring = set()
         self.exporters: dict[str, ExporterSession] = {}
         self.clients: dict[str, ClientSession] = {}
+        self.match_index = ResourceMatchIndex()
         self.load()
 
         self.loop = asyncio.get_running_loop()
@@ -206,13 +239,13 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
             traceback.print_exc()
         # try to re-acquire orphaned resources
         try:
-            async with self.lock:
-                await self._reacquire_orphaned_resources()
+            await self._reacquire_orphaned_resources()
         except Exception:  # pylint: disable=broad-except
             traceback.print_exc()
         # update reservations
         try:
-            self.schedule_reservations()
+            async with self.reservation_lock:
+                self.schedule_reservations()
         except Exception:  # pylint: disable=broad-except
             traceback.print_exc()
 
@@ -226,6 +259,15 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
             except Exception:  # pylint: disable=broad-except
                 traceback.print_exc()
 
+    def _get_place_lock(self, name):
+        lock = self.place_locks.get(name)
+        if lock is None:
+            lock = asyncio.Lock()
+            # only keep locks for existing places
+            if name in self.places:
+                self.place_locks[name] = lock
+        return lock
+
     def save_later(self):
         logging.debug("Setting Save-later")
         self.save_scheduled = True
@@ -271,6 +313,8 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
                 config["matches"] = [ResourceMatch(**match) for match in config["matches"]]
                 place = Place(**config)
                 self.places[placename] = place
+                for match in place.matches:
+                    self.match_index.add_match(placename, match)
         except FileNotFoundError:
             pass
         logging.info("loaded %s place(s)", len(self.places))
@@ -334,8 +378,10 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
             return
         place = Place(name)
         print(place)
-        place.matches.append(ResourceMatch(exporter="*", group=name, cls="*"))
+        match = ResourceMatch(exporter="*", group=name, cls="*")
+        place.matches.append(match)
         self.places[name] = place
+        self.match_index.add_match(name, match)
 
     def get_exporter_by_name(self, name):
         for exporter in self.exporters.values():
@@ -455,8 +501,11 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
             await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "name was not a string")
         if name not in self.places:
             await context.abort(grpc.StatusCode.ALREADY_EXISTS, f"Place {name} does not exist")
-        logging.debug("Deleting %s", name)
-        del self.places[name]
+        async with self._get_place_lock(name):
+            logging.debug("Deleting %s", name)
+            del self.places[name]
+            self.place_locks.pop(name, None)
+            self.match_index.remove_place(name)
         msg = labgrid_coordinator_pb2.ClientOutMessage()
         msg.updates.add().del_place = name
         for client in self.clients.values():
@@ -464,7 +513,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         self.save_later()
         return labgrid_coordinator_pb2.DeletePlaceResponse()
 
-    @locked
+    @place_locked
     async def AddPlaceAlias(self, request, context):
         placename = request.placename
         alias = request.alias
@@ -478,7 +527,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         self.save_later()
         return labgrid_coordinator_pb2.AddPlaceAliasResponse()
 
-    @locked
+    @place_locked
     async def DeletePlaceAlias(self, request, context):
         placename = request.placename
         alias = request.alias
@@ -495,7 +544,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         self.save_later()
         return labgrid_coordinator_pb2.DeletePlaceAliasResponse()
 
-    @locked
+    @place_locked
     async def SetPlaceTags(self, request, context):
         placename = request.placename
         tags = dict(request.tags)
@@ -524,7 +573,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         self.save_later()
         return labgrid_coordinator_pb2.SetPlaceTagsResponse()
 
-    @locked
+    @place_locked
     async def SetPlaceComment(self, request, context):
         placename = request.placename
         comment = request.comment
@@ -538,7 +587,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         self.save_later()
         return labgrid_coordinator_pb2.SetPlaceCommentResponse()
 
-    @locked
+    @place_locked
     async def AddPlaceMatch(self, request, context):
         placename = request.placename
         pattern = request.pattern
@@ -551,12 +600,13 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         if rm in place.matches:
             await context.abort(grpc.StatusCode.ALREADY_EXISTS, f"Match {rm} already exists")
         place.matches.append(rm)
+        self.match_index.add_match(placename, rm)
         place.touch()
         self._publish_place(place)
         self.save_later()
         return labgrid_coordinator_pb2.AddPlaceMatchResponse()
 
-    @locked
+    @place_locked
     async def DeletePlaceMatch(self, request, context):
         placename = request.placename
         pattern = request.pattern
@@ -570,43 +620,84 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
             place.matches.remove(rm)
         except ValueError:
             await context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Match {rm} does not exist in {placename}")
+        self.match_index.remove_match(placename, rm)
         place.touch()
         self._publish_place(place)
         self.save_later()
         return labgrid_coordinator_pb2.DeletePlaceMatchResponse()
 
+    async def _set_acquired(self, resources, place_name=None):
+        """Send ExporterSetAcquiredRequests for all resources at once and wait
+        for the responses together.
+
+        The requests are queued per ExporterSession before waiting, so the
+        requests for one exporter are pipelined on its stream and the exporters
+        are handled concurrently. A place_name of None requests a release.
+
+        Returns a dict mapping each resource to None on success or to the
+        exception which occurred.
+        """
+        results = {}
+        commands = {}
+        for resource in resources:
+            exporter = self.get_exporter_by_name(resource.path[0])
+            if exporter is None:
+                results[resource] = ExporterError(f"exporter for {resource} is not connected")
+                continue
+            # this triggers an update from the exporter which is published
+            # to the clients
+            request = labgrid_coordinator_pb2.ExporterSetAcquiredRequest()
+            request.group_name = resource.path[1]
+            request.resource_name = resource.path[3]
+            if place_name is not None:
+                request.place_name = place_name
+            # otherwise request.place_name is left unset to indicate release
+            cmd = ExporterCommand(request)
+            exporter.queue.put_nowait(cmd)
+            commands[resource] = cmd
+
+        async def wait(resource, cmd):
+            await cmd.wait()
+            if not cmd.response.success:
+                action = "acquire" if place_name is not None else "release"
+                raise ExporterError(f"failed to {action} {resource}")
+
+        done = await asyncio.gather(*(wait(r, c) for r, c in commands.items()), return_exceptions=True)
+        results.update(zip(commands, done))
+        return results
+
     async def _acquire_resource(self, place, resource):
-        assert self.lock.locked()
-
-        # this triggers an update from the exporter which is published
-        # to the clients
-        request = labgrid_coordinator_pb2.ExporterSetAcquiredRequest()
-        request.group_name = resource.path[1]
-        request.resource_name = resource.path[3]
-        request.place_name = place.name
-        cmd = ExporterCommand(request)
-        self.get_exporter_by_name(resource.path[0]).queue.put_nowait(cmd)
-        await cmd.wait()
-        if not cmd.response.success:
-            raise ExporterError("failed to acquire {resource}")
+        assert self._get_place_lock(place.name).locked()
+        assert resource not in self.acquiring
+
+        self.acquiring.add(resource)
+        try:
+            error = (await self._set_acquired([resource], place.name))[resource]
+        finally:
+            self.acquiring.discard(resource)
+        if error is not None:
+            raise error
 
     async def _acquire_resources(self, place, resources):
-        assert self.lock.locked()
+        assert self._get_place_lock(place.name).locked()
 
         resources = resources.copy()  # we may modify the list
         # all resources need to be free
         for resource in resources:
-            if resource.acquired:
+            if resource.acquired or resource in self.acquiring:
                 return False
 
         # acquire resources
-        acquired = []
+        self.acquiring.update(resources)
         try:
-            for resource in resources:
-                await self._acquire_resource(place, resource)
-                acquired.append(resource)
-        except Exception:
-            logging.exception("failed to acquire %s", resource)
+            results = await self._set_acquired(resources, place.name)
+        finally:
+            self.acquiring.difference_update(resources)
+        acquired = [resource for resource, error in results.items() if error is None]
+        if len(acquired) != len(resources):
+            for resource, error in results.items():
+                if error is not None:
+                    logging.error("failed to acquire %s", resource, exc_info=error)
             # cleanup
             await self._release_resources(place, acquired)
             return False
@@ -617,7 +708,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         return True
 
     async def _release_resources(self, place, resources, callback=True):
-        assert self.lock.locked()
+        assert self._get_place_lock(place.name).locked()
 
         resources = resources.copy()  # we may modify the list
 
@@ -627,73 +718,84 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
             except ValueError:
                 pass
 
-        for resource in resources:
-            if resource.orphaned:
+        if not callback:
+            return
+
+        results = await self._set_acquired([resource for resource in resources if not resource.orphaned])
+        for resource, error in results.items():
+            if error is None:
                 continue
+            logging.error("failed to release %s", resource, exc_info=error)
+            # at leaset try to notify the clients
             try:
-                # this triggers an update from the exporter which is published
-                # to the clients
-                if callback:
-                    request = labgrid_coordinator_pb2.ExporterSetAcquiredRequest()
-                    request.group_name = resource.path[1]
-                    request.resource_name = resource.path[3]
-                    # request.place_name is left unset to indicate release
-                    cmd = ExporterCommand(request)
-                    self.get_exporter_by_name(resource.path[0]).queue.put_nowait(cmd)
-                    await cmd.wait()
-                    if not cmd.response.success:
-                        raise ExporterError(f"failed to release {resource}")
-            except (ExporterError, TimeoutError):
-                logging.exception("failed to release %s", resource)
-                # at leaset try to notify the clients
-                try:
-                    self._publish_resource(resource)
-                except:
-                    logging.exception("failed to publish released resource %s", resource)
+                self._publish_resource(resource)
+            except:
+                logging.exception("failed to publish released resource %s", resource)
+
+    async def _reacquire_orphaned_resources(self, locked_place=None):
+        """Try to reacquire orphaned resources for all places.
+
+        If called with a place lock held, that place must be passed as
+        locked_place. Other places are then skipped if their lock is not free,
+        as waiting for them could deadlock.
+        """
+        if locked_place:
+            assert self._get_place_lock(locked_place.name).locked()
+
+        for place in list(self.places.values()):
+            if not any(resource.orphaned for resource in place.acquired_resources):
+                continue
+            if place is locked_place:
+                await self._reacquire_orphaned_place_resources(place)
+                continue
+            lock = self._get_place_lock(place.name)
+            if locked_place and lock.locked():
+                continue
+            async with lock:
+                if self.places.get(place.name) is not place:
+                    continue  # deleted in the meantime
+                await self._reacquire_orphaned_place_resources(place)
 
-    async def _reacquire_orphaned_resources(self):
-        assert self.lock.locked()
+    async def _reacquire_orphaned_place_resources(self, place):
+        assert self._get_place_lock(place.name).locked()
 
-        for place in self.places.values():
-            changed = False
+        changed = False
 
-            for idx, resource in enumerate(place.acquired_resources):
-                if not resource.orphaned:
-                    continue
+        for idx, resource in enumerate(place.acquired_resources):
+            if not resource.orphaned:
+                continue
 
-                # is the exporter connected again?
-                exporter = self.get_exporter_by_name(resource.path[0])
-                if not exporter:
-                    continue
+            # is the exporter connected again?
+            exporter = self.get_exporter_by_name(resource.path[0])
+            if not exporter:
+                continue
 
-                # does the resource exist again?
-                try:
-                    new_resource = exporter.groups[resource.path[1]][resource.path[3]]
-                except KeyError:
-                    continue
+            # does the resource exist again?
+            try:
+                new_resource = exporter.groups[resource.path[1]][resource.path[3]]
+            except KeyError:
+                continue
 
-                if new_resource.acquired:
-                    # this should only happen when resources become broken
-                    logging.debug("ignoring acquired/broken resource %s for place %s", new_resource, place.name)
-                    continue
+            if new_resource.acquired or new_resource in self.acquiring:
+                # this should only happen when resources become broken
+                logging.debug("ignoring acquired/broken resource %s for place %s", new_resource, place.name)
+                continue
 
-                try:
-                    await self._acquire_resource(place, new_resource)
-                    place.acquired_resources[idx] = new_resource
-                except Exception:
-                    logging.exception(
-                        "failed to reacquire orphaned resource %s for place %s", new_resource, place.name
-                    )
-                    break
-
-                logging.info("reacquired orphaned resource %s for place %s", new_resource, place.name)
-                changed = True
-
-            if changed:
-                self._publish_place(place)
-                self.save_later()
+            try:
+                await self._acquire_resource(place, new_resource)
+                place.acquired_resources[idx] = new_resource
+            except Exception:
+                logging.exception("failed to reacquire orphaned resource %s for place %s", new_resource, place.name)
+                break
 
-    @locked
+            logging.info("reacquired orphaned resource %s for place %s", new_resource, place.name)
+            changed = True
+
+        if changed:
+            self._publish_place(place)
+            self.save_later()
+
+    @place_locked
     async def AcquirePlace(self, request, context):
         peer = context.peer()
         name = request.placename
@@ -715,18 +817,12 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
                 await context.abort(grpc.StatusCode.PERMISSION_DENIED, f"Place {name} was not reserved for {username}")
 
         # First try to reacquire orphaned resources to avoid conflicts.
-        await self._reacquire_orphaned_resources()
+        await self._reacquire_orphaned_resources(locked_place=place)
 
         # FIXME use the session object instead? or something else which
         # survives disconnecting clients?
         place.acquired = username
-        resources = []
-        for _, session in sorted(self.exporters.items()):
-            for _, group in sorted(session.groups.items()):
-                for _, resource in sorted(group.items()):
-                    if not place.hasmatch(resource.path):
-                        continue
-                    resources.append(resource)
+        resources = sorted(self.match_index.get_resources(name), key=lambda x: (x.path[0], x.path[1], x.path[3]))
         if not await self._acquire_resources(place, resources):
             # revert earlier change
             place.acquired = None
@@ -734,11 +830,12 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         place.touch()
         self._publish_place(place)
         self.save_later()
-        self.schedule_reservations()
+        async with self.reservation_lock:
+            self.schedule_reservations()
         print(f"{place.name}: place acquired by {place.acquired}")
         return labgrid_coordinator_pb2.AcquirePlaceResponse()
 
-    @locked
+    @place_locked
     async def ReleasePlace(self, request, context):
         name = request.placename
         print(request)
@@ -761,11 +858,12 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         place.touch()
         self._publish_place(place)
         self.save_later()
-        self.schedule_reservations()
+        async with self.reservation_lock:
+            self.schedule_reservations()
         print(f"{place.name}: place released")
         return labgrid_coordinator_pb2.ReleasePlaceResponse()
 
-    @locked
+    @place_locked
     async def AllowPlace(self, request, context):
         placename = request.placename
         user = request.user
@@ -793,7 +891,6 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
     def _get_places(self):
         return {k: v.asdict() for k, v in self.places.items()}
 
-    @locked
     async def GetPlaces(self, unused_request, unused_context):
         logging.debug("GetPlaces")
         try:
@@ -906,7 +1003,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
             if old_map.get(name) != new_map.get(name):
                 self._publish_place(place)
 
-    @locked
+    @reservation_locked
     async def CreateReservation(self, request: labgrid_coordinator_pb2.CreateReservationRequest, context):
         peer = context.peer()
 
@@ -930,7 +1027,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         self.schedule_reservations()
         return labgrid_coordinator_pb2.CreateReservationResponse(reservation=res.as_pb2())
 
-    @locked
+    @reservation_locked
     async def CancelReservation(self, request: labgrid_coordinator_pb2.CancelReservationRequest, context):
         token = request.token
         if not isinstance(token, str) or not token:
@@ -941,7 +1038,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         self.schedule_reservations()
         return labgrid_coordinator_pb2.CancelReservationResponse()
 
-    @locked
+    @reservation_locked
     async def PollReservation(self, request: labgrid_coordinator_pb2.PollReservationRequest, context):
         token = request.token
         try:
@@ -951,7 +1048,7 @@ class Coordinator(labgrid_coordinator_pb2_grpc.CoordinatorServicer):
         res.refresh()
         return labgrid_coordinator_pb2.PollReservationResponse(reservation=res.as_pb2())
 
-    @locked
+    @reservation_locked
     async def GetReservations(self, request: labgrid_coordinator_pb2.GetReservationsRequest, context):
         reservations = [x.as_pb2() for x in self.reservations.values()]
         return labgrid_coordinator_pb2.GetReservationsResponse(reservations=reservations)
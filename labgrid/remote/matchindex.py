@@ -0,0 +1,177 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+import attr
+
+from .common import ResourceMatch
+
+FIELDS = ("exporter", "group", "cls")
+GLOB_CHARS = "*?["
+
+
+def literal_prefix(pattern):
+    "Return the part of an fnmatch pattern before the first wildcard."
+    for i, c in enumerate(pattern):
+        if c in GLOB_CHARS:
+            return pattern[:i]
+    return pattern
+
+
+def is_literal(pattern):
+    return not any(c in pattern for c in GLOB_CHARS)
+
+
+@attr.s(eq=False)
+class MatchEntry:
+    """A ResourceMatch registered for a place, together with the resources it
+    currently matches."""
+
+    place_name = attr.ib(validator=attr.validators.instance_of(str))
+    match = attr.ib(validator=attr.validators.instance_of(ResourceMatch))
+    resources = attr.ib(default=attr.Factory(set), init=False)
+
+    def key(self):
+        """Select the path field with the longest literal prefix.
+
+        Indexing each match only under its most selective field keeps the
+        number of candidates low for the common patterns like
+        '*/<group>/*' or '<exporter>/*/*'.
+        """
+        best = None
+        for idx, field in enumerate(FIELDS):
+            pattern = getattr(self.match, field)
+            prefix = literal_prefix(pattern)
+            if best is None or len(prefix) > len(best[2]):
+                best = (idx, pattern, prefix)
+        return best
+
+
+class PatternIndex:
+    "Map fnmatch patterns on a single path field to their entries."
+
+    def __init__(self):
+        self.literal = defaultdict(set)
+        self.prefixed = defaultdict(set)
+
+    def add(self, pattern, prefix, entry):
+        if pattern == prefix:
+            self.literal[pattern].add(entry)
+        else:
+            self.prefixed[prefix].add(entry)
+
+    def remove(self, pattern, prefix, entry):
+        bucket = self.literal if pattern == prefix else self.prefixed
+        bucket[prefix].discard(entry)
+        if not bucket[prefix]:
+            del bucket[prefix]
+
+    def candidates(self, value):
+        yield from self.literal.get(value, ())
+        # every prefix of the value (including the empty one) may select
+        # a bucket of glob patterns
+        for i in range(len(value) + 1):
+            yield from self.prefixed.get(value[:i], ())
+
+
+class ValueIndex:
+    "Map the values of a single path field to resources, ordered for prefix lookups."
+
+    def __init__(self):
+        self.values = defaultdict(set)
+        self.ordered = []
+
+    def add(self, value, resource):
+        if value not in self.values:
+            insort(self.ordered, value)
+        self.values[value].add(resource)
+
+    def remove(self, value, resource):
+        resources = self.values.get(value)
+        if resources is None:
+            return
+        resources.discard(resource)
+        if not resources:
+            del self.values[value]
+            del self.ordered[bisect_left(self.ordered, value)]
+
+    def candidates(self, pattern, prefix):
+        if pattern == prefix:
+            yield from self.values.get(pattern, ())
+            return
+        for value in self.ordered[bisect_left(self.ordered, prefix) :]:
+            if not value.startswith(prefix):
+                break
+            yield from self.values[value]
+
+
+class ResourceMatchIndex:
+    """Incrementally maintained mapping of places to the resources matched by
+    their ResourceMatches.
+
+    Resources are expected to have a `path` attribute with the structure
+    (exporter, group, cls, name).
+    """
+
+    def __init__(self):
+        self.entries = defaultdict(list)  # place name -> [MatchEntry]
+        self.patterns = [PatternIndex() for _ in FIELDS]
+        self.values = [ValueIndex() for _ in FIELDS]
+        self.resources = {}  # resource -> {MatchEntry}
+
+    def add_resource(self, resource):
+        if resource in self.resources:
+            return
+        path = resource.path
+        entries = self.resources[resource] = set()
+        for idx, value in enumerate(path[: len(FIELDS)]):
+            self.values[idx].add(value, resource)
+            for entry in self.patterns[idx].candidates(value):
+                if entry.match.ismatch(path):
+                    entry.resources.add(resource)
+                    entries.add(entry)
+
+    def remove_resource(self, resource):
+        entries = self.resources.pop(resource, None)
+        if entries is None:
+            return
+        for idx, value in enumerate(resource.path[: len(FIELDS)]):
+            self.values[idx].remove(value, resource)
+        for entry in entries:
+            entry.resources.discard(resource)
+
+    def add_match(self, place_name, match):
+        entry = MatchEntry(place_name, match)
+        idx, pattern, prefix = entry.key()
+        self.patterns[idx].add(pattern, prefix, entry)
+        self.entries[place_name].append(entry)
+        for resource in self.values[idx].candidates(pattern, prefix):
+            if match.ismatch(resource.path):
+                entry.resources.add(resource)
+                self.resources[resource].add(entry)
+
+    def _remove_entry(self, entry):
+        idx, pattern, prefix = entry.key()
+        self.patterns[idx].remove(pattern, prefix, entry)
+        for resource in entry.resources:
+            self.resources[resource].discard(entry)
+
+    def remove_match(self, place_name, match):
+        entries = self.entries.get(place_name, [])
+        for entry in entries:
+            if entry.match == match:
+                entries.remove(entry)
+                self._remove_entry(entry)
+                break
+        if not entries:
+            self.entries.pop(place_name, None)
+
+    def remove_place(self, place_name):
+        for entry in self.entries.pop(place_name, []):
+            self._remove_entry(entry)
+
+    def get_resources(self, place_name):
+        "Return the set of resources matched by any match of the given place."
+        result = set()
+        for entry in self.entries.get(place_name, ()):
+            result |= entry.resources
+        return result
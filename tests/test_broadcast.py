@@ -0,0 +1,118 @@
+import asyncio
+
+from labgrid.remote.broadcast import ClientOutQueue, serialize_update, update_key
+from labgrid.remote.generated import labgrid_coordinator_pb2
+
+
+def place_update(name, comment=""):
+    update = labgrid_coordinator_pb2.UpdateResponse()
+    update.place.name = name
+    update.place.comment = comment
+    return update
+
+
+def resource_update(exporter, group, name, avail=True):
+    update = labgrid_coordinator_pb2.UpdateResponse()
+    update.resource.cls = "NetworkSerialPort"
+    update.resource.avail = avail
+    update.resource.path.exporter_name = exporter
+    update.resource.path.group_name = group
+    update.resource.path.resource_name = name
+    return update
+
+
+def put(queue, update):
+    queue.put_update(update_key(update), serialize_update(update))
+
+
+def parse(data):
+    return labgrid_coordinator_pb2.ClientOutMessage.FromString(data)
+
+
+def test_update_key():
+    assert update_key(place_update("a")) == ("place", "a")
+    deleted = labgrid_coordinator_pb2.UpdateResponse(del_place="a")
+    assert update_key(deleted) == ("place", "a")
+
+    update = resource_update("exp", "group", "serial")
+    assert update_key(update) == ("resource", "exp", "group", "serial")
+    deleted = labgrid_coordinator_pb2.UpdateResponse()
+    deleted.del_resource.CopyFrom(update.resource.path)
+    assert update_key(deleted) == update_key(update)
+
+
+def test_concatenated_updates():
+    queue = ClientOutQueue()
+    put(queue, place_update("a"))
+    put(queue, resource_update("exp", "group", "serial"))
+
+    msg = parse(queue.get_nowait())
+    assert [u.WhichOneof("kind") for u in msg.updates] == ["place", "resource"]
+    assert not msg.HasField("sync")
+    assert queue.get_nowait() is None
+
+
+def test_coalesce():
+    queue = ClientOutQueue()
+    put(queue, resource_update("exp", "group", "serial", avail=True))
+    put(queue, place_update("a"))
+    put(queue, resource_update("exp", "group", "serial", avail=False))
+    put(queue, place_update("a", comment="updated"))
+    assert len(queue) == 2
+
+    msg = parse(queue.get_nowait())
+    assert len(msg.updates) == 2
+    assert msg.updates[0].resource.avail is False
+    assert msg.updates[1].place.comment == "updated"
+
+
+def test_sync_ends_message():
+    queue = ClientOutQueue()
+    put(queue, place_update("a"))
+    queue.put_sync(1)
+    queue.put_sync(2)
+    put(queue, place_update("b"))
+
+    msg = parse(queue.get_nowait())
+    assert [u.place.name for u in msg.updates] == ["a"]
+    assert msg.sync.id == 1
+    msg = parse(queue.get_nowait())
+    assert not msg.updates
+    assert msg.sync.id == 2
+    msg = parse(queue.get_nowait())
+    assert [u.place.name for u in msg.updates] == ["b"]
+    assert not msg.HasField("sync")
+
+
+def test_batches():
+    queue = ClientOutQueue()
+    for i in range(250):
+        put(queue, place_update(f"place-{i}"))
+
+    sizes = []
+    while (data := queue.get_nowait()) is not None:
+        sizes.append(len(parse(data).updates))
+    assert sizes == [100, 100, 50]
+
+
+def test_messages():
+    async def run():
+        queue = ClientOutQueue()
+        received = []
+
+        async def consume():
+            async for data in queue.messages():
+                received.append(parse(data))
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0)
+        put(queue, place_update("a"))
+        await asyncio.sleep(0)
+        queue.put_sync(7)
+        queue.close()
+        await asyncio.wait_for(task, 1)
+        return received
+
+    received = asyncio.run(run())
+    assert [len(msg.updates) for msg in received] == [1, 0]
+    assert received[1].sync.id == 7
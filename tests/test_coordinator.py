@@ -163,3 +163,131 @@ def test_coordinator_create_reservation(coordinator, coordinator_place):
     assert res
     res: labgrid_coordinator_pb2.CreateReservationResponse
     assert len(res.reservation.token) > 0
+
+def run_with_coordinator(tmp_path, monkeypatch, func):
+    """Run func(coordinator) in a fresh event loop with an in-process Coordinator."""
+    import asyncio
+    from labgrid.remote.coordinator import Coordinator
+
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        coordinator = Coordinator()
+        try:
+            return await func(coordinator)
+        finally:
+            coordinator.poll_task.cancel()
+
+    return asyncio.run(run())
+
+def add_fake_exporter(coordinator, name, groups):
+    import asyncio
+    from labgrid.remote.coordinator import ExporterSession
+
+    session = ExporterSession(coordinator, f"peer-{name}", name, asyncio.Queue(), "2.0.0")
+    coordinator.exporters[session.peer] = session
+    for group_name, resource_names in groups.items():
+        for resource_name in resource_names:
+            resource = labgrid_coordinator_pb2.Resource(cls="NetworkSerialPort", avail=True)
+            session.set_resource(group_name, resource_name, resource)
+    return session
+
+def test_coordinator_acquire_fanout(tmp_path, monkeypatch):
+    import asyncio
+    from labgrid.remote.common import Place, ResourceMatch
+
+    async def func(coordinator):
+        sessions = [
+            add_fake_exporter(coordinator, f"exporter{i}", {"board": [f"port{j}" for j in range(4)]})
+            for i in range(3)
+        ]
+        place = coordinator.places["board"] = Place("board", matches=[ResourceMatch("*", "board", "*")])
+        resources = [r for s in sessions for r in s.groups["board"].values()]
+
+        async with coordinator._get_place_lock("board"):
+            task = asyncio.create_task(coordinator._acquire_resources(place, resources))
+            await asyncio.sleep(0)
+            # all requests are queued before any response arrives
+            assert [s.queue.qsize() for s in sessions] == [4, 4, 4]
+            for s in sessions:
+                while not s.queue.empty():
+                    cmd = s.queue.get_nowait()
+                    assert cmd.request.place_name == "board"
+                    cmd.complete(labgrid_coordinator_pb2.ExporterResponse(success=True))
+            assert await task
+
+        assert place.acquired_resources == resources
+
+    run_with_coordinator(tmp_path, monkeypatch, func)
+
+def test_coordinator_acquire_fanout_rollback(tmp_path, monkeypatch):
+    import asyncio
+    from labgrid.remote.common import Place, ResourceMatch
+
+    async def func(coordinator):
+        sessions = [
+            add_fake_exporter(coordinator, f"exporter{i}", {"board": ["port0", "port1"]})
+            for i in range(2)
+        ]
+        place = coordinator.places["board"] = Place("board", matches=[ResourceMatch("*", "board", "*")])
+        resources = [r for s in sessions for r in s.groups["board"].values()]
+        requests = []
+
+        async def respond(session):
+            while True:
+                cmd = await session.queue.get()
+                requests.append((session.name, cmd.request.resource_name, cmd.request.place_name))
+                success = not (session.name == "exporter1" and cmd.request.resource_name == "port1")
+                cmd.complete(labgrid_coordinator_pb2.ExporterResponse(success=success))
+
+        responders = [asyncio.create_task(respond(s)) for s in sessions]
+        try:
+            async with coordinator._get_place_lock("board"):
+                assert not await coordinator._acquire_resources(place, resources)
+        finally:
+            for responder in responders:
+                responder.cancel()
+
+        assert place.acquired_resources == []
+        released = {(exporter, resource) for exporter, resource, place_name in requests if not place_name}
+        assert released == {("exporter0", "port0"), ("exporter0", "port1"), ("exporter1", "port0")}
+
+    run_with_coordinator(tmp_path, monkeypatch, func)
+
+def test_coordinator_place_locks(tmp_path, monkeypatch):
+    import asyncio
+    from labgrid.remote.common import Place, ResourceMatch
+
+    class FakeContext:
+        def peer(self):
+            return "ipv4:127.0.0.1:1234"
+
+        async def abort(self, code, details):
+            raise Exception(f"{code}: {details}")
+
+    async def func(coordinator):
+        session = add_fake_exporter(coordinator, "exporter", {"shared": ["port"]})
+        resource = session.groups["shared"]["port"]
+        for name in ["a", "b"]:
+            coordinator.places[name] = Place(name, matches=[ResourceMatch("*", "shared", "*")])
+
+        async with coordinator._get_place_lock("a"):
+            # an acquire of place a is in progress
+            task = asyncio.create_task(coordinator._acquire_resources(coordinator.places["a"], [resource]))
+            await asyncio.sleep(0)
+            assert session.queue.qsize() == 1
+
+            # unrelated operations on place b do not wait for place a
+            request = labgrid_coordinator_pb2.SetPlaceTagsRequest(placename="b", tags={"board": "foo"})
+            await asyncio.wait_for(coordinator.SetPlaceTags(request, FakeContext()), 1)
+            assert coordinator.places["b"].tags == {"board": "foo"}
+
+            # the pending resource cannot be acquired for place b
+            async with coordinator._get_place_lock("b"):
+                assert not await coordinator._acquire_resources(coordinator.places["b"], [resource])
+            assert session.queue.qsize() == 1
+
+            session.queue.get_nowait().complete(labgrid_coordinator_pb2.ExporterResponse(success=True))
+            assert await task
+
+    run_with_coordinator(tmp_path, monkeypatch, func)
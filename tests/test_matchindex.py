@@ -0,0 +1,110 @@
+import attr
+
+from labgrid.remote.common import ResourceMatch
+from labgrid.remote.matchindex import ResourceMatchIndex, literal_prefix
+
+
+@attr.s(eq=False)
+class FakeResource:
+    path = attr.ib()
+
+
+def test_literal_prefix():
+    assert literal_prefix('exporter') == 'exporter'
+    assert literal_prefix('board-*') == 'board-'
+    assert literal_prefix('*') == ''
+    assert literal_prefix('ab?d') == 'ab'
+    assert literal_prefix('a[bc]') == 'a'
+
+
+def test_resource_then_match():
+    index = ResourceMatchIndex()
+    r1 = FakeResource(('exp1', 'board-1', 'NetworkSerialPort', 'serial'))
+    r2 = FakeResource(('exp1', 'board-2', 'NetworkSerialPort', 'serial'))
+    r3 = FakeResource(('exp2', 'board-1', 'NetworkPowerPort', 'power'))
+    for r in (r1, r2, r3):
+        index.add_resource(r)
+
+    index.add_match('place-1', ResourceMatch('*', 'board-1', '*'))
+    assert index.get_resources('place-1') == {r1, r3}
+
+    index.add_match('place-2', ResourceMatch('exp1', 'board-*', 'NetworkSerialPort'))
+    assert index.get_resources('place-2') == {r1, r2}
+
+    index.add_match('place-3', ResourceMatch('*', '*', '*', 'power'))
+    assert index.get_resources('place-3') == {r3}
+
+    assert index.get_resources('unknown') == set()
+
+
+def test_match_then_resource():
+    index = ResourceMatchIndex()
+    index.add_match('place-1', ResourceMatch('*', 'board-1', '*'))
+    index.add_match('place-2', ResourceMatch('exp*', '*', 'Network*'))
+
+    r1 = FakeResource(('exp1', 'board-1', 'NetworkSerialPort', 'serial'))
+    r2 = FakeResource(('other', 'board-1', 'USBSerialPort', 'serial'))
+    index.add_resource(r1)
+    index.add_resource(r2)
+
+    assert index.get_resources('place-1') == {r1, r2}
+    assert index.get_resources('place-2') == {r1}
+
+    index.remove_resource(r1)
+    assert index.get_resources('place-1') == {r2}
+    assert index.get_resources('place-2') == set()
+
+
+def test_remove_match():
+    index = ResourceMatchIndex()
+    r1 = FakeResource(('exp1', 'board-1', 'NetworkSerialPort', 'serial'))
+    r2 = FakeResource(('exp1', 'board-1', 'NetworkPowerPort', 'power'))
+    index.add_resource(r1)
+    index.add_resource(r2)
+
+    index.add_match('place-1', ResourceMatch('exp1', 'board-1', 'NetworkSerialPort'))
+    index.add_match('place-1', ResourceMatch('exp1', '*', 'NetworkPowerPort'))
+    assert index.get_resources('place-1') == {r1, r2}
+
+    # rename is metadata only
+    index.remove_match('place-1', ResourceMatch('exp1', 'board-1', 'NetworkSerialPort', rename='console'))
+    assert index.get_resources('place-1') == {r2}
+
+    index.remove_place('place-1')
+    assert index.get_resources('place-1') == set()
+
+    # resources can still be removed after their matches are gone
+    index.remove_resource(r1)
+    index.remove_resource(r2)
+    assert not index.resources
+
+
+def test_consistent_with_hasmatch():
+    from labgrid.remote.common import Place
+
+    resources = []
+    for e in range(3):
+        for g in range(4):
+            for cls in ('NetworkSerialPort', 'NetworkPowerPort', 'NetworkService'):
+                resources.append(FakeResource((f'exp{e}', f'group-{g}', cls, cls.lower())))
+
+    matches = [
+        ResourceMatch('*', 'group-1', '*'),
+        ResourceMatch('exp?', 'group-[23]', 'Network*Port'),
+        ResourceMatch('exp2', '*', '*', 'networkservice'),
+        ResourceMatch('*', '*', 'NetworkPowerPort'),
+        ResourceMatch('exp1', 'group-0', 'NetworkService'),
+    ]
+
+    index = ResourceMatchIndex()
+    for r in resources[::2]:
+        index.add_resource(r)
+    for i, m in enumerate(matches):
+        index.add_match(f'place-{i}', m)
+    for r in resources[1::2]:
+        index.add_resource(r)
+
+    for i, m in enumerate(matches):
+        place = Place(f'place-{i}', matches=[m])
+        expected = {r for r in resources if place.hasmatch(r.path)}
+        assert index.get_resources(f'place-{i}') == expected